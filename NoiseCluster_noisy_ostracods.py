@@ -62,6 +62,7 @@ if args.seed is not None:
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     cudnn.deterministic = True
+    cudnn.benchmark = False
 
 
 def create_model(pretrained):
@@ -94,8 +95,8 @@ def train_by_iter(model, train_iter, ceriation, train_optimizer, num_iter):
         train_optimizer.step()
 
         acc1, acc5 = accuracy(logits, labels, topk=(1, 5))
-        losses.update(loss.item(), images[0].size(0))
-        top1.update(acc1[0], images[0].size(0))
+        losses.update(loss.item(), images.size(0))
+        top1.update(acc1[0], images.size(0))
         batch_time.update(time.time() - end)
         end = time.time()
         batch_id = batch_idx
@@ -106,7 +107,7 @@ def train_by_iter(model, train_iter, ceriation, train_optimizer, num_iter):
 
 def update_trainloader(model, train_noisy_labels, val_nums):
     # confusing
-    predict_dataset = Noisy_ostracods_unlabeled('train', train_transform)
+    predict_dataset = Noisy_ostracods_unlabeled('train', train_transform, draft_size=IMAGE_SIZE)
     predict_loader = DataLoader(dataset=predict_dataset, batch_size=args.batch_size * 2, shuffle=False, num_workers=16, pin_memory=True, drop_last=False)
     soft_outs = predict_softmax(predict_loader, model)
     _, preds = torch.max(soft_outs.data, 1)
@@ -220,7 +221,9 @@ def calculate_Multicore_tSNE(features, n_jobs=8):
     return tx, ty
 
 
-train_transform = transforms.Compose([transforms.Resize([224, 224]),
+# (h, w), shared by Resize and the datasets' JPEG draft decoding
+IMAGE_SIZE = [224, 224]
+train_transform = transforms.Compose([transforms.Resize(IMAGE_SIZE),
                                           transforms.RandomChoice([transforms.RandomRotation([90, 90]),
                                                                    transforms.RandomRotation([180, 180]),
                                                                    transforms.RandomRotation([270, 270])],
@@ -235,7 +238,7 @@ train_transform = transforms.Compose([transforms.Resize([224, 224]),
                                               mean=[0.485, 0.456, 0.406],
                                               std=[0.229, 0.224, 0.225])])
 
-transform_test = transforms.Compose([transforms.Resize([224, 224]),
+transform_test = transforms.Compose([transforms.Resize(IMAGE_SIZE),
                                                 transforms.ToTensor(),
                                                 transforms.Normalize(
                                                     mean=[0.485, 0.456, 0.406],
@@ -247,12 +250,12 @@ val_labels = val_label
 val_nums = np.zeros(args.num_classes, dtype=int)
 for item in val_labels:
     val_nums[item] += 1
-val_dataset = Noisy_ostracods(val_data, val_label, transform_test)
+val_dataset = Noisy_ostracods(val_data, val_label, transform_test, draft_size=IMAGE_SIZE)
 val_loader = DataLoader(dataset=val_dataset, batch_size=args.batch_size * 2, num_workers=16, pin_memory=True, shuffle=False, drop_last=False)
 
 # test_data = kvDic['test_data']
 # test_labels = kvDic['test_labels']
-test_dataset = Noisy_ostracods(test_data, test_label, transform_test)
+test_dataset = Noisy_ostracods(test_data, test_label, transform_test, draft_size=IMAGE_SIZE)
 test_loader = DataLoader(dataset=test_dataset, batch_size=args.batch_size * 2, num_workers=16, pin_memory=True, shuffle=False, drop_last=False)
 
 original_train_data = train_data
@@ -266,7 +269,7 @@ original_train_labels = original_train_labels[shuffle_index]
 nosie_len = int(len(original_train_labels) * args.data_percent)
 whole_train_data = original_train_data[:nosie_len]
 whole_train_labels = original_train_labels[:nosie_len]
-train_dataset = Noisy_ostracods(whole_train_data, whole_train_labels, train_transform)
+train_dataset = Noisy_ostracods(whole_train_data, whole_train_labels, train_transform, draft_size=IMAGE_SIZE)
 train_loader = DataLoader(dataset=train_dataset, batch_size=args.batch_size, num_workers=16, pin_memory=True, shuffle=True, drop_last=True)
 
 model = create_model(args.pretrain)
@@ -281,7 +284,7 @@ rest_train_data = original_train_data
 rest_train_labels = original_train_labels
 confident_index, unconfident_index, class_weights = update_trainloader(model, rest_train_labels, val_nums)
 print(confident_index.shape, unconfident_index.shape, class_weights.shape)
-predict_dataset = Noisy_ostracods(rest_train_data[confident_index], rest_train_labels[confident_index], transform_test)
+predict_dataset = Noisy_ostracods(rest_train_data[confident_index], rest_train_labels[confident_index], transform_test, draft_size=IMAGE_SIZE)
 predict_loader = DataLoader(dataset=predict_dataset, batch_size=args.batch_size, num_workers=8, pin_memory=True, shuffle=False, drop_last=False)
 
 # print('Confidence index')
@@ -306,7 +309,7 @@ re_train_labels = db_con_labels[db_con_index]
 print("re_train_labels:", re_train_labels)
 print("re_train_data shape:", re_train_data.shape)
 print("retrain_data:", re_train_data[0])
-re_dataset = Noisy_ostracods(re_train_data, re_train_labels, train_transform)
+re_dataset = Noisy_ostracods(re_train_data, re_train_labels, train_transform, draft_size=IMAGE_SIZE)
 re_loader = DataLoader(dataset=re_dataset, batch_size=args.batch_size, num_workers=16, pin_memory=True, shuffle=True, drop_last=True)
 
 # Continue to train
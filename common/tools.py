@@ -6,12 +6,16 @@ import pandas as pd
 
 import torch
 import torch.nn.functional as F
-from torch.autograd import Variable
 from torch.cuda.amp import autocast
 import torchvision.transforms as transforms
 from torch.utils.data import Dataset
 from PIL import Image
 
+torch.backends.cudnn.benchmark = True
+
+# torch.inference_mode needs torch>=1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
 
 def getTime():
     time_stamp = datetime.datetime.now()
@@ -24,11 +28,11 @@ class AverageMeter(object):
     def __init__(self, name, fmt=':f'):
         self.name = name
         self.fmt = fmt
+        self._fmtstr = '{name} {avg' + fmt + '}'
         self.reset()
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
         self.count = 0
 
@@ -36,11 +40,28 @@ class AverageMeter(object):
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def avg(self):
+        # computed on read so update() stays a plain accumulate
+        return self.sum / self.count if self.count else 0
 
     def __str__(self):
-        fmtstr = '{name} {avg' + self.fmt + '}'
-        return fmtstr.format(**self.__dict__)
+        return self._fmtstr.format(name=self.name, avg=self.avg)
+
+
+class GpuAverageMeter(AverageMeter):
+    """Keeps the running sum on the tensor's device so updates do not sync with the host"""
+
+    def update(self, val, n=1):
+        super().update(val.detach().float(), n)
+
+    @property
+    def avg(self):
+        # keep .item() working for callers when the loader was empty
+        if self.count == 0:
+            return torch.zeros(())
+        return self.sum / self.count
 
 
 class ProgressMeter(object):
@@ -60,6 +81,54 @@ class ProgressMeter(object):
         return '[' + fmt + '/' + fmt.format(num_batches) + ']'
 
 
+class CudaPrefetcher(object):
+    """Copies the next batch to the GPU on a side stream while the current one is consumed"""
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        batch = None
+        for next_batch in self.loader:
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                next_batch = [t.cuda(non_blocking=True) for t in next_batch]
+
+            if batch is not None:
+                yield batch
+
+            torch.cuda.current_stream().wait_stream(stream)
+            for t in next_batch:
+                t.record_stream(torch.cuda.current_stream())
+            batch = next_batch
+
+        if batch is not None:
+            yield batch
+
+
+def maybe_compile(model, compile=False):
+    # CUDA Graphs replay via "reduce-overhead"; torch.compile needs torch>=2.0
+    if compile and hasattr(torch, 'compile'):
+        return torch.compile(model, mode="reduce-overhead")
+    return model
+
+
+def eval_autocast(amp_dtype=torch.bfloat16):
+    if amp_dtype is None:
+        return autocast(enabled=False)
+    # bf16 autocast needs torch>=1.10 and an Ampere or newer GPU; use fp16 otherwise
+    if amp_dtype == torch.bfloat16 and not (hasattr(torch.cuda, 'is_bf16_supported') and torch.cuda.is_bf16_supported()):
+        amp_dtype = torch.float16
+    # the dtype argument arrived with torch.autocast in 1.10; older autocast is fp16 only
+    if not hasattr(torch, 'autocast'):
+        return autocast()
+    return autocast(dtype=amp_dtype)
+
+
 def accuracy(output, target, topk=(1,)):
     with torch.no_grad():
         maxk = max(topk)
@@ -69,155 +138,226 @@ def accuracy(output, target, topk=(1,)):
         pred = pred.t()
         correct = pred.eq(target.view(1, -1).expand_as(pred))
 
-        res = []
-        for k in topk:
-            correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
-            res.append(correct_k.mul_(100.0 / batch_size))
-        return res
+        # hits per rank, accumulated so entry k-1 counts hits within the top-k
+        correct_k = correct.float().sum(1).cumsum(0).mul_(100.0 / batch_size)
+        return [correct_k[k - 1:k] for k in topk]
 
 
-def train(model, train_loader, optimizer, ceriation, epoch, amp=False):
+def train(model, train_loader, optimizer, ceriation, epoch, amp=False, compile=False, scaler=None, print_freq=None):
     batch_time = AverageMeter('Time', ':6.2f')
     data_time = AverageMeter('Data', ':6.2f')
-    losses = AverageMeter('Loss', ':6.2f')
-    top1 = AverageMeter('Acc@1', ':6.2f')
+    losses = GpuAverageMeter('Loss', ':6.2f')
+    top1 = GpuAverageMeter('Acc@1', ':6.2f')
     progress = ProgressMeter(len(train_loader), [batch_time, data_time, losses, top1], prefix=getTime() + " Train Epoch: [{}]".format(epoch + 1))
-    scaler = torch.cuda.amp.GradScaler()
+    if amp and scaler is None:
+        # pass a scaler in to keep the calibrated loss scale across epochs
+        scaler = torch.cuda.amp.GradScaler()
 
     model.train()
+    model.to(memory_format=torch.channels_last)
+
+    def train_step(images, labels):
+        logist = model(images)
+        loss = ceriation(logist, labels)
+        return logist, loss
+
+    # backward and the scaler stay outside the compiled region
+    train_step = maybe_compile(train_step, compile)
+
     end = time.time()
-    for i, (images, labels) in enumerate(train_loader):
+    for i, (images, labels) in enumerate(CudaPrefetcher(train_loader)):
         # measure data loading time
         data_time.update(time.time() - end)
-        images = images.cuda(non_blocking=True)
-        labels = labels.cuda(non_blocking=True)
+        images = images.to(memory_format=torch.channels_last)
+        bs = images.size(0)
 
         if amp:
             with autocast():
-                logist = model(images)
-                loss = ceriation(logist, labels)
+                logist, loss = train_step(images, labels)
 
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             scaler.scale(loss).backward()
             scaler.step(optimizer)
             scaler.update()
         else:
-            logist = model(images)
-            loss = ceriation(logist, labels)
+            logist, loss = train_step(images, labels)
 
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss.backward()
             optimizer.step()
 
         acc1, acc5 = accuracy(logist, labels, topk=(1, 5))
-        losses.update(loss.item(), images[0].size(0))
-        top1.update(acc1[0], images[0].size(0))
+        losses.update(loss, bs)
+        top1.update(acc1[0], bs)
         batch_time.update(time.time() - end)
         end = time.time()
 
+        # printing reads the device meters, so it syncs; by default only once per epoch
+        if print_freq and i % print_freq == 0:
+            progress.display(i)
+
     progress.display(0)
-    return losses.avg, top1.avg.to("cpu", torch.float).item()
+    return losses.avg.item(), top1.avg.item()
 
 
-def evaluate(model, eva_loader, ceriation, prefix, ignore=-1):
-    losses = AverageMeter('Loss', ':3.2f')
-    top1 = AverageMeter('Acc@1', ':3.2f')
+def evaluate(model, eva_loader, ceriation, prefix, ignore=-1, compile=False, amp_dtype=torch.bfloat16):
+    losses = GpuAverageMeter('Loss', ':3.2f')
+    top1 = GpuAverageMeter('Acc@1', ':3.2f')
     model.eval()
+    model.to(memory_format=torch.channels_last)
 
-    with torch.no_grad():
-        for i, (images, labels) in enumerate(eva_loader):
-            images = images.cuda()
-            labels = labels.cuda()
+    with inference_mode():
+        model = maybe_compile(model, compile)
+        for i, (images, labels) in enumerate(CudaPrefetcher(eva_loader)):
+            images = images.to(memory_format=torch.channels_last)
+            bs = images.size(0)
 
-            logist = model(images)
+            with eval_autocast(amp_dtype):
+                logist = model(images)
+                loss = ceriation(logist, labels)
 
-            loss = ceriation(logist, labels)
             acc1, acc5 = accuracy(logist, labels, topk=(1, 5))
 
-            losses.update(loss.item(), images[0].size(0))
-            top1.update(acc1[0], images[0].size(0))
+            losses.update(loss, bs)
+            top1.update(acc1[0], bs)
 
     if prefix != "":
         print(getTime(), prefix, round(top1.avg.item(), 2))
 
-    return losses.avg, top1.avg.to("cpu", torch.float).item()
+    return losses.avg.item(), top1.avg.item()
 
 
-def evaluateWithBoth(model1, model2, eva_loader, prefix):
+def evaluateWithBoth(model1, model2, eva_loader, prefix, compile=False, amp_dtype=torch.bfloat16):
     model1.eval()
     model2.eval()
-    top1 = AverageMeter('Acc@1', ':3.2f')
+    model1.to(memory_format=torch.channels_last)
+    model2.to(memory_format=torch.channels_last)
+    top1 = GpuAverageMeter('Acc@1', ':3.2f')
 
-    with torch.no_grad():
+    with inference_mode():
+        model1 = maybe_compile(model1, compile)
+        model2 = maybe_compile(model2, compile)
         for i, (images, labels) in enumerate(eva_loader):
-            images = images.cuda()
-            labels = labels.cuda()
-
-            logist1 = model1(images)
-            logist2 = model2(images)
-            logist = (F.softmax(logist1, dim=1) + F.softmax(logist2, dim=1)) / 2
+            images = images.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+            labels = labels.cuda(non_blocking=True)
+            bs = images.size(0)
+
+            with eval_autocast(amp_dtype):
+                logist1 = model1(images)
+                if compile:
+                    # CUDA Graphs may reuse this output buffer on the next replay
+                    logist1 = logist1.clone()
+                logist2 = model2(images)
+            logist = F.softmax(torch.stack([logist1, logist2]).float(), dim=-1).mean(dim=0)
             acc1, acc5 = accuracy(logist, labels, topk=(1, 5))
-            top1.update(acc1[0], images[0].size(0))
+            top1.update(acc1[0], bs)
 
     if prefix != "":
         print(getTime(), prefix, round(top1.avg.item(), 2))
 
-    return top1.avg.to("cpu", torch.float).item()
+    return top1.avg.item()
 
 
-def predict(predict_loader, model):
+def predict(predict_loader, model, compile=False, amp_dtype=torch.bfloat16):
     model.eval()
-    preds = []
-    probs = []
-
-    with torch.no_grad():
+    model.to(memory_format=torch.channels_last)
+    num_samples = len(predict_loader.dataset)
+    preds = torch.empty(num_samples, dtype=torch.long, device='cuda')
+    probs = torch.empty(num_samples, device='cuda')
+    offset = 0
+
+    with inference_mode():
+        model = maybe_compile(model, compile)
         for images, _, _ in predict_loader:
-            if torch.cuda.is_available():
-                images = Variable(images).cuda()
+            images = images.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+            with eval_autocast(amp_dtype):
                 logits = model(images)
-                outputs = F.softmax(logits, dim=1)
-                prob, pred = torch.max(outputs.data, 1)
-                preds.append(pred)
-                probs.append(prob)
+            outputs = F.softmax(logits.float(), dim=1)
+            prob, pred = torch.max(outputs.data, 1)
+            preds[offset:offset + pred.size(0)] = pred
+            probs[offset:offset + prob.size(0)] = prob
+            offset += pred.size(0)
 
-    return torch.cat(preds, dim=0).cpu(), torch.cat(probs, dim=0).cpu()
+    # the loader may yield fewer rows than the dataset (drop_last, samplers)
+    return preds[:offset].cpu(), probs[:offset].cpu()
 
 
-def predict_softmax(predict_loader, model):
+def predict_softmax(predict_loader, model, compile=False, amp_dtype=torch.bfloat16):
     model.eval()
-    softmax_outs = []
-    with torch.no_grad():
+    model.to(memory_format=torch.channels_last)
+    num_samples = len(predict_loader.dataset)
+    softmax_outs = None
+    offset = 0
+    with inference_mode():
+        model = maybe_compile(model, compile)
         for images1, images2 in predict_loader:
-            if torch.cuda.is_available():
-                images1 = images1.cuda()
-                images2 = images2.cuda()
-
-            logits1 = model(images1)
-            logits2 = model(images2)
-            outputs = (F.softmax(logits1, dim=1) + F.softmax(logits2, dim=1)) / 2
-            softmax_outs.append(outputs)
-
-    return torch.cat(softmax_outs, dim=0).cpu()
-
-
-def predict_repre(predict_loader, model):
+            images1 = images1.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+            images2 = images2.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+
+            with eval_autocast(amp_dtype):
+                logits1 = model(images1)
+                if compile:
+                    # CUDA Graphs reuse this output buffer on the next replay
+                    logits1 = logits1.clone()
+                logits2 = model(images2)
+            outputs = F.softmax(torch.stack([logits1, logits2]).float(), dim=-1).mean(dim=0)
+            if softmax_outs is None:
+                # the class count is only known once the first batch is through
+                softmax_outs = outputs.new_empty((num_samples, outputs.size(1)))
+            softmax_outs[offset:offset + outputs.size(0)] = outputs
+            offset += outputs.size(0)
+
+    return softmax_outs[:offset].cpu()
+
+
+def predict_repre(predict_loader, model, compile=False, amp_dtype=torch.bfloat16):
     model.eval()    # Change model to 'eval' mode.
-    repres = []
-    with torch.no_grad():
+    model.to(memory_format=torch.channels_last)
+    num_samples = len(predict_loader.dataset)
+    repres = None
+    offset = 0
+    copy_stream = torch.cuda.Stream()
+    with inference_mode():
+        model = maybe_compile(model, compile)
         for images, _ in predict_loader:
-            images = images.cuda()
-            outputs = model(images)
-            repres.append(outputs)
-
-    repres = torch.cat(repres, dim=0)
-    return repres.detach().cpu().numpy()
+            images = images.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+            with eval_autocast(amp_dtype):
+                outputs = model(images)
+            # numpy has no bfloat16
+            outputs = outputs.float()
+            if compile:
+                # CUDA Graphs reuse their output buffer on the next replay
+                outputs = outputs.clone()
+            if repres is None:
+                repres = torch.empty((num_samples, outputs.size(1)), pin_memory=True)
+
+            # stream each batch to pinned host memory so only one batch stays on the GPU
+            copy_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(copy_stream):
+                repres[offset:offset + outputs.size(0)].copy_(outputs, non_blocking=True)
+            outputs.record_stream(copy_stream)
+            offset += outputs.size(0)
+
+    copy_stream.synchronize()
+    return repres[:offset].numpy()
+
+
+def pil_loader(path, draft_size=None):
+    # draft_size is (h, w) like transforms.Resize; PIL's draft takes (w, h)
+    img = Image.open(path)
+    if draft_size is not None:
+        # let libjpeg decode at a reduced scale that still covers draft_size; no-op for non-JPEG files
+        img.draft('RGB', (draft_size[1], draft_size[0]))
+    return img.convert('RGB')
 
 
 class Clothing1M_Dataset(Dataset):
-    def __init__(self, data, labels, root_dir, transform=None, target_transform=None):
+    def __init__(self, data, labels, root_dir, transform=None, target_transform=None, draft_size=None):
         self.data = np.array(data)
-        self.targets = np.array(labels)
+        self.targets = np.asarray(labels, dtype=np.int64)
         self.root_dir = root_dir
+        self.paths = np.array([os.path.join(root_dir, p) for p in self.data])
+        self.draft_size = draft_size
         self.length = len(self.targets)
 
         if transform is None:
@@ -228,10 +368,8 @@ class Clothing1M_Dataset(Dataset):
         self.target_transform = target_transform
 
     def __getitem__(self, index):
-        img_paths, target = self.data[index], self.targets[index]
-
-        img_paths = os.path.join(self.root_dir, img_paths)
-        img = Image.open(img_paths).convert('RGB')
+        img = pil_loader(self.paths[index], self.draft_size)
+        target = int(self.targets[index])
 
         if self.transform is not None:
             img = self.transform(img)
@@ -248,18 +386,18 @@ class Clothing1M_Dataset(Dataset):
         return self.data, self.targets
     
 class Noisy_ostracods(Dataset):
-    def __init__(self, data, labels, transform=None):
+    def __init__(self, data, labels, transform=None, draft_size=None):
         self.data = data
+        self.draft_size = draft_size
         self.fixed_image_base_path = '/mnt/x/class_images' #'/mnt/e/data/ostracods_id/class_images'
         self.transform = transform
-        self.labels = labels
+        self.labels = np.asarray(labels, dtype=np.int64)
         self.root_dir = self.fixed_image_base_path
+        self.paths = np.array([os.path.join(self.root_dir, p) for p in data])
     
     def __getitem__(self, index):
-        img_paths, target = self.data[index], self.labels[index]
-
-        img_paths = os.path.join(self.root_dir, img_paths)
-        img = Image.open(img_paths).convert('RGB')
+        img = pil_loader(self.paths[index], self.draft_size)
+        target = int(self.labels[index])
 
         if self.transform is not None:
             img = self.transform(img)
@@ -276,32 +414,40 @@ class Noisy_ostracods(Dataset):
         return len(self.data)
     
 class Noisy_ostracods_unlabeled(Dataset):
-    def __init__(self, train, transform=None):
+    def __init__(self, train, transform=None, draft_size=None):
         self.fixed_annotation_path = f'/mnt/d/Noisy_ostracods/datasets/ostracods_genus_final_{train}.csv'
         self.fixed_image_base_path = '/mnt/x/class_images' #'/mnt/e/data/ostracods_id/class_images'
-        self.transform = transform
         self.train = train
         self.img_labels = pd.read_csv(self.fixed_annotation_path, header=None)
-        # transform img_labels[,1] to a 1-d array of np-int8 as labels
-        self.targets = self.img_labels[1].values.astype(np.int8)
+        # int8 overflows past 127 classes
+        self.targets = self.img_labels[1].values.astype(np.int64)
         self.root_dir = self.fixed_image_base_path
+        self.draft_size = draft_size
+        self.paths = np.array([os.path.join(self.root_dir, p) for p in self.img_labels[0].values])
+
+        if transform is None:
+            self.transform = transforms.ToTensor()
+        else:
+            self.transform = transform
     
     def __getitem__(self, idx):
-        img_path = os.path.join(self.fixed_image_base_path, self.img_labels.iloc[idx, 0])
-        image = Image.open(img_path)
+        # decode once, then draw two independently augmented views for predict_softmax
+        image = pil_loader(self.paths[idx], self.draft_size)
+        img1 = self.transform(image)
         img2 = self.transform(image)
-        image = self.transform(image)
-        return image, img2
+        return img1, img2
     
 
     def __len__(self):
-        return len(self.img_labels)
+        return len(self.paths)
 
 
 class Clothing1M_Unlabeled_Dataset(Dataset):
-    def __init__(self, data, root_dir, transform=None):
+    def __init__(self, data, root_dir, transform=None, draft_size=None):
         self.train_data = np.array(data)
         self.root_dir = root_dir
+        self.draft_size = draft_size
+        self.paths = np.array([os.path.join(root_dir, p) for p in self.train_data])
         self.length = len(self.train_data)
 
         if transform is None:
@@ -310,9 +456,7 @@ class Clothing1M_Unlabeled_Dataset(Dataset):
             self.transform = transform
 
     def __getitem__(self, index):
-        img_paths = self.train_data[index]
-        img_paths = os.path.join(self.root_dir, img_paths)
-        img = Image.open(img_paths).convert('RGB')
+        img = pil_loader(self.paths[index], self.draft_size)
 
         if self.transform is not None:
             img1 = self.transform(img)